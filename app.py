@@ -1,8 +1,14 @@
 import streamlit as st
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 import os
 import re
+import csv
 import hashlib
+import html
+import threading
 from datetime import datetime
 
 # Ensure required directories exist
@@ -19,53 +25,239 @@ if 'user_email' not in st.session_state:
 if 'user_id' not in st.session_state:
     st.session_state.user_id = ""
 if 'messages' not in st.session_state:
-    st.session_state.messages = []
+    st.session_state.messages = None
+if 'messages_signature' not in st.session_state:
+    st.session_state.messages_signature = None
+if 'stored_message_count' not in st.session_state:
+    st.session_state.stored_message_count = 0
 if 'selected_recipient' not in st.session_state:
     st.session_state.selected_recipient = "everyone"
 if 'show_create_group' not in st.session_state:
     st.session_state.show_create_group = False
+if 'recipient_cache' not in st.session_state:
+    st.session_state.recipient_cache = None
+if 'message_render_cache' not in st.session_state:
+    st.session_state.message_render_cache = None
 
-# CSV files
+# Data files
 CHAT_FILE = "chat_log.csv"
+CHAT_ARCHIVE_FILE = "chat_log.parquet"
+CHAT_SHARD_PREFIX = "chat_log-"
+CHAT_COMPACT_MARKER_FILE = "chat_log.compacting"
 USERS_FILE = "registered_users.csv"
 GROUPS_FILE = "groups.csv"
+GROUP_MEMBERS_FILE = "group_members.csv"
+DELETED_MESSAGES_FILE = "deleted_messages.csv"
+
+# CSV headers
+CHAT_COLUMNS = ['timestamp', 'email', 'user_id', 'message', 'recipient', 'kind']
+USERS_COLUMNS = ['email', 'user_id', 'first_login']
+GROUPS_COLUMNS = ['group_id', 'group_name', 'creator', 'created_at']
+GROUP_MEMBERS_COLUMNS = ['group_id', 'email']
+DELETED_MESSAGES_COLUMNS = ['message_index']
+
+# New messages are appended to CHAT_FILE and folded into CHAT_ARCHIVE_FILE
+# once the CSV grows past this size
+CHAT_COMPACT_BYTES = 256 * 1024
+
+# Deleted messages are recorded in DELETED_MESSAGES_FILE and only removed
+# from storage at compaction, which also runs once this share is deleted
+DELETED_COMPACT_RATIO = 0.1
+
+# Only the most recent messages are loaded for display; the archive is
+# written in row groups of this size so its tail can be read on its own
+MAX_LOADED_MESSAGES = 2000
+MAX_DISPLAYED_MESSAGES = 200
+CHAT_ARCHIVE_ROW_GROUP = 1000
+
+# Once the archive holds more than this many messages, all but the most
+# recent MAX_LOADED_MESSAGES are moved to a dated chat_log-*.parquet shard
+# so compaction only ever rewrites a bounded file
+CHAT_ARCHIVE_MAX_ROWS = 50000
+
+# Email validation
+EMAIL_PATTERN = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}\Z')
+MAX_EMAIL_LENGTH = 254
 
 def is_valid_email(email):
     """Validate email format"""
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return re.match(pattern, email) is not None
+    # Bound the input before matching so long strings can't cause heavy backtracking
+    if len(email) > MAX_EMAIL_LENGTH:
+        return False
+    return EMAIL_PATTERN.match(email) is not None
 
 def generate_user_id(email):
     """Generate a unique user ID based on email"""
-    return hashlib.md5(email.encode()).hexdigest()[:8]
+    return hashlib.blake2b(email.encode(), digest_size=4).hexdigest()
 
 def generate_group_id(group_name):
     """Generate a unique group ID based on group name and timestamp"""
     timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-    return hashlib.md5(f"{group_name}_{timestamp}".encode()).hexdigest()[:8]
+    return hashlib.blake2b(f"{group_name}_{timestamp}".encode(), digest_size=4).hexdigest()
+
+def message_kind(recipient):
+    """Classify a recipient as 'public', 'dm' (an email) or 'group' (a group ID)"""
+    if recipient == "everyone":
+        return 'public'
+    if '@' in str(recipient):
+        return 'dm'
+    return 'group'
+
+def append_rows(path, columns, rows):
+    """Append rows to a CSV file, writing the header if the file is new
+    
+    Returns the size of the file after the write.
+    """
+    with open(path, 'a', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_MINIMAL, lineterminator='\n')
+        # Append mode opens at the end of the file, so position 0 means it is empty
+        if f.tell() == 0:
+            writer.writerow(columns)
+        writer.writerows(rows)
+        f.flush()
+        return f.tell()
+
+def append_row(path, columns, row):
+    """Append a single row to a CSV file, writing the header if the file is new"""
+    return append_rows(path, columns, [row])
+
+@st.cache_resource(show_spinner=False)
+def chat_log_handle():
+    """Shared append handle for the chat log, kept open across reruns and sessions
+    
+    The lock also serializes compaction and deletions against appends, and
+    is re-entrant so those can close the handle while holding it.
+    """
+    return {'lock': threading.RLock(), 'file': None}
+
+def close_chat_log_handle():
+    """Close the shared chat log handle so the next append reopens the file"""
+    handle = chat_log_handle()
+    with handle['lock']:
+        if handle['file'] is not None:
+            handle['file'].close()
+            handle['file'] = None
+
+def append_chat_row(row):
+    """Append a message to the chat log through the shared handle
+    
+    Returns the size of the log before and after the write.
+    """
+    handle = chat_log_handle()
+    with handle['lock']:
+        f = handle['file']
+        # Reopen if the log was removed or replaced since the handle was opened
+        if f is not None:
+            try:
+                if os.stat(CHAT_FILE).st_ino != os.fstat(f.fileno()).st_ino:
+                    f.close()
+                    f = None
+            except FileNotFoundError:
+                f.close()
+                f = None
+        if f is None:
+            # Rows are written in CHAT_COLUMNS order, so bring an older log up to date first
+            upgrade_chat_log_file()
+            f = open(CHAT_FILE, 'a', buffering=1 << 16, newline='', encoding='utf-8')
+            handle['file'] = f
+        
+        try:
+            writer = csv.writer(f, quoting=csv.QUOTE_MINIMAL, lineterminator='\n')
+            size_before = f.tell()
+            if size_before == 0:
+                writer.writerow(CHAT_COLUMNS)
+            writer.writerow(row)
+            # Flush so readers see the message; fsync is skipped on purpose
+            f.flush()
+            return size_before, f.tell()
+        except Exception:
+            f.close()
+            handle['file'] = None
+            raise
+
+# Each file change produces a new cache key, so the cached readers below keep
+# only a few entries instead of every past version of the files
+def file_signature(path):
+    """Return a cache key that changes whenever the file changes on disk"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+def read_text_csv(path, columns=None):
+    """Parse a CSV file with pyarrow, keeping every column as non-null text
+    
+    Every column in these files is a string, so parsing skips type inference
+    and NA detection (a message reading "NA" stays text). Rows with the wrong
+    number of fields, such as a line torn by an interrupted write, are skipped.
+    """
+    with open(path, newline='', encoding='utf-8') as f:
+        header = next(csv.reader(f), [])
+    convert_options = pa_csv.ConvertOptions(
+        include_columns=columns or [],
+        column_types={name: pa.string() for name in header},
+        strings_can_be_null=False
+    )
+    # Messages can span several lines, which pyarrow's default chunking can't handle
+    parse_options = pa_csv.ParseOptions(
+        newlines_in_values=True,
+        invalid_row_handler=lambda row: 'skip'
+    )
+    return pa_csv.read_csv(path, parse_options=parse_options, convert_options=convert_options).to_pandas()
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def read_csv_cached(path, signature):
+    """Read a CSV file, reusing the parsed result until its signature changes"""
+    return read_text_csv(path)
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def read_parquet_cached(path, signature):
+    """Read a Parquet file, reusing the parsed result until its signature changes"""
+    return pd.read_parquet(path)
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def read_parquet_tail_cached(path, signature, max_rows):
+    """Read the last max_rows rows of a Parquet file, indexed by their position in the file"""
+    parquet_file = pq.ParquetFile(path)
+    total_rows = parquet_file.metadata.num_rows
+    
+    # Walk row groups back from the end until enough rows are covered
+    row_groups = []
+    covered_rows = 0
+    for i in reversed(range(parquet_file.num_row_groups)):
+        if covered_rows >= max_rows:
+            break
+        row_groups.insert(0, i)
+        covered_rows += parquet_file.metadata.row_group(i).num_rows
+    
+    if not row_groups:
+        return pd.DataFrame(columns=CHAT_COLUMNS)
+    df = parquet_file.read_row_groups(row_groups).to_pandas().tail(max_rows)
+    df.index = pd.RangeIndex(total_rows - len(df), total_rows)
+    return df
+
+@st.cache_resource(show_spinner=False, max_entries=1)
+def registered_user_ids_cached(signature):
+    """Map registered emails to user IDs, rebuilt only when the users file changes"""
+    users_df = read_text_csv(USERS_FILE, columns=['email', 'user_id'])
+    return dict(zip(users_df['email'], users_df['user_id']))
 
 def register_user(email):
     """Register a new user or return existing user info"""
     try:
-        user_id = generate_user_id(email)
+        # Check if user already exists, keeping the ID they registered with
+        signature = file_signature(USERS_FILE)
+        if signature is not None:
+            existing_id = registered_user_ids_cached(signature).get(email)
+            if existing_id is not None:
+                return existing_id, False  # User exists
         
-        # Check if users file exists
-        if os.path.exists(USERS_FILE):
-            users_df = pd.read_csv(USERS_FILE)
-            # Check if user already exists
-            if email in users_df['email'].values:
-                return user_id, False  # User exists
-        else:
-            users_df = pd.DataFrame(columns=['email', 'user_id', 'first_login'])
+        user_id = generate_user_id(email)
         
         # Add new user
-        new_user = {
-            'email': email,
-            'user_id': user_id,
-            'first_login': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        }
-        users_df = pd.concat([users_df, pd.DataFrame([new_user])], ignore_index=True)
-        users_df.to_csv(USERS_FILE, index=False)
+        first_login = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        append_row(USERS_FILE, USERS_COLUMNS, [email, user_id, first_login])
         
         return user_id, True  # New user
     except Exception as e:
@@ -81,62 +273,127 @@ def create_group(group_name, creator_email, members):
         if creator_email not in members:
             members.append(creator_email)
         
-        # Check if groups file exists
-        if os.path.exists(GROUPS_FILE):
-            groups_df = pd.read_csv(GROUPS_FILE)
-        else:
-            groups_df = pd.DataFrame(columns=['group_id', 'group_name', 'creator', 'members', 'created_at'])
-        
-        # Add new group
-        new_group = {
-            'group_id': group_id,
-            'group_name': group_name,
-            'creator': creator_email,
-            'members': ','.join(members),
-            'created_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        }
-        groups_df = pd.concat([groups_df, pd.DataFrame([new_group])], ignore_index=True)
-        groups_df.to_csv(GROUPS_FILE, index=False)
+        # Make sure an old-style groups file is converted before appending to it
+        load_groups()
+        
+        # Add new group and one membership row per member
+        created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        append_row(GROUPS_FILE, GROUPS_COLUMNS, [group_id, group_name, creator_email, created_at])
+        append_rows(GROUP_MEMBERS_FILE, GROUP_MEMBERS_COLUMNS, [[group_id, member] for member in members])
         
         return group_id, True
     except Exception as e:
         st.error(f"Error creating group: {e}")
         return None, False
 
+def load_groups():
+    """Load the groups and group membership tables"""
+    groups_signature = file_signature(GROUPS_FILE)
+    if groups_signature is None:
+        return pd.DataFrame(columns=GROUPS_COLUMNS), pd.DataFrame(columns=GROUP_MEMBERS_COLUMNS)
+    
+    groups_df = read_csv_cached(GROUPS_FILE, groups_signature)
+    
+    # Move comma-joined member lists from old groups files into the members file
+    if 'members' in groups_df.columns:
+        legacy_members = groups_df[['group_id']].assign(
+            email=groups_df['members'].str.split(',')
+        ).explode('email')
+        legacy_members = legacy_members[legacy_members['email'].fillna('') != '']
+        append_rows(GROUP_MEMBERS_FILE, GROUP_MEMBERS_COLUMNS,
+                    legacy_members.itertuples(index=False, name=None))
+        groups_df = groups_df[GROUPS_COLUMNS]
+        groups_df.to_csv(GROUPS_FILE, index=False)
+    
+    members_signature = file_signature(GROUP_MEMBERS_FILE)
+    if members_signature is None:
+        return groups_df, pd.DataFrame(columns=GROUP_MEMBERS_COLUMNS)
+    return groups_df, read_csv_cached(GROUP_MEMBERS_FILE, members_signature)
+
 def get_user_groups(user_email):
     """Get all groups that the user is a member of"""
-    if not os.path.exists(GROUPS_FILE):
-        return []
-    
     try:
-        groups_df = pd.read_csv(GROUPS_FILE)
-        user_groups = []
-        
-        for _, group in groups_df.iterrows():
-            members = group['members'].split(',')
-            if user_email in members:
-                user_groups.append({
-                    'group_id': group['group_id'],
-                    'group_name': group['group_name'],
-                    'creator': group['creator'],
-                    'members': members
-                })
-        
-        return user_groups
+        groups_df, members_df = load_groups()
+        
+        user_group_ids = set(members_df.loc[members_df['email'] == user_email, 'group_id'])
+        if not user_group_ids:
+            return []
+        
+        members_by_group = (
+            members_df[members_df['group_id'].isin(user_group_ids)]
+            .groupby('group_id')['email']
+            .agg(list)
+        )
+        user_groups_df = groups_df[groups_df['group_id'].isin(user_group_ids)]
+        
+        return [
+            {
+                'group_id': group.group_id,
+                'group_name': group.group_name,
+                'creator': group.creator,
+                'members': members_by_group.get(group.group_id, [])
+            }
+            for group in user_groups_df.itertuples(index=False)
+        ]
     except Exception as e:
         st.error(f"Error loading groups: {e}")
         return []
 
-def delete_message(message_index):
-    """Delete a message by its index"""
+@st.cache_resource(show_spinner=False, max_entries=1)
+def deleted_indices_cached(signature):
+    """Get the set of deleted message indices, rebuilt only when the file changes"""
+    deleted_df = read_text_csv(DELETED_MESSAGES_FILE)
+    return frozenset(deleted_df['message_index'].astype('int64').tolist())
+
+def get_deleted_indices():
+    """Get the indices of messages that have been deleted but not yet compacted away"""
+    signature = file_signature(DELETED_MESSAGES_FILE)
+    if signature is None:
+        return frozenset()
+    return deleted_indices_cached(signature)
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def archive_row_count_cached(signature):
+    """Count the rows in the Parquet archive from its footer, once per archive change"""
+    return pq.read_metadata(CHAT_ARCHIVE_FILE).num_rows
+
+def count_archived_messages():
+    """Count the rows stored in the Parquet archive, including deleted ones"""
+    signature = file_signature(CHAT_ARCHIVE_FILE)
+    if signature is None:
+        return 0
+    return archive_row_count_cached(signature)
+
+def stored_message_sender(message_index):
+    """Get the email of the stored message at message_index, reading only its row group"""
+    archive_rows = count_archived_messages()
+    if message_index >= archive_rows:
+        return load_chat_log_df()['email'].iloc[message_index - archive_rows]
+    
+    parquet_file = pq.ParquetFile(CHAT_ARCHIVE_FILE)
+    for i in range(parquet_file.num_row_groups):
+        group_rows = parquet_file.metadata.row_group(i).num_rows
+        if message_index < group_rows:
+            return parquet_file.read_row_group(i, columns=['email'])['email'][message_index].as_py()
+        message_index -= group_rows
+    return None
+
+def delete_message(message_index, user_email):
+    """Delete a message by its index if it was sent by user_email"""
     try:
-        if os.path.exists(CHAT_FILE):
-            df = pd.read_csv(CHAT_FILE)
-            if 0 <= message_index < len(df):
-                df = df.drop(df.index[message_index])
-                df.to_csv(CHAT_FILE, index=False)
+        # Indices shift at compaction, so check and record them under the log lock
+        with chat_log_handle()['lock']:
+            finish_chat_compaction()
+            stored_msgs = count_archived_messages() + len(load_chat_log_df())
+            deleted = get_deleted_indices()
+            if (0 <= message_index < stored_msgs and message_index not in deleted and
+                    stored_message_sender(message_index) == user_email):
+                append_row(DELETED_MESSAGES_FILE, DELETED_MESSAGES_COLUMNS, [message_index])
+                
+                if len(deleted) + 1 > stored_msgs * DELETED_COMPACT_RATIO:
+                    compact_chat_log()
                 return True
-        return False
+            return False
     except Exception as e:
         st.error(f"Error deleting message: {e}")
         return False
@@ -146,179 +403,466 @@ def get_user_display_name(email):
     return email.split('@')[0]
 
 def get_registered_users():
-    """Get list of all registered users"""
-    if os.path.exists(USERS_FILE):
-        users_df = pd.read_csv(USERS_FILE)
-        return users_df[['email', 'user_id']].to_dict('records')
+    """Get (email, user_id) pairs for all registered users"""
+    signature = file_signature(USERS_FILE)
+    if signature is not None:
+        return list(registered_user_ids_cached(signature).items())
     return []
 
-def load_messages():
-    """Load messages from CSV file"""
-    if os.path.exists(CHAT_FILE):
+def get_registered_emails():
+    """Get registered emails in registration order, as a set-like view"""
+    signature = file_signature(USERS_FILE)
+    if signature is not None:
+        return registered_user_ids_cached(signature).keys()
+    return {}.keys()
+
+def upgrade_chat_columns(df):
+    """Add columns missing from older chat logs, returning True if any were added"""
+    upgraded = False
+    if 'recipient' not in df.columns:
+        df['recipient'] = 'everyone'
+        upgraded = True
+    if 'kind' not in df.columns:
+        df['kind'] = df['recipient'].map(message_kind)
+        upgraded = True
+    return upgraded
+
+def upgrade_chat_log_file():
+    """Rewrite a CSV log from before the recipient and kind columns existed
+    
+    Must be called while holding the chat log lock.
+    """
+    try:
+        with open(CHAT_FILE, newline='', encoding='utf-8') as f:
+            header = next(csv.reader(f), [])
+    except FileNotFoundError:
+        return
+    if header and header != CHAT_COLUMNS:
+        df = read_text_csv(CHAT_FILE)
+        upgrade_chat_columns(df)
+        close_chat_log_handle()
+        temp_file = f"{CHAT_FILE}.tmp"
+        df[CHAT_COLUMNS].to_csv(temp_file, index=False)
+        os.replace(temp_file, CHAT_FILE)
+
+def load_chat_log_df():
+    """Load the messages not yet folded into the archive from the CSV log"""
+    signature = file_signature(CHAT_FILE)
+    if signature is None:
+        return pd.DataFrame(columns=CHAT_COLUMNS)
+    
+    df = read_csv_cached(CHAT_FILE, signature)
+    # Ensure newer columns exist for backwards compatibility
+    if upgrade_chat_columns(df):
+        with chat_log_handle()['lock']:
+            # Appends upgrade the file first, so only rewrite if it is unchanged
+            if file_signature(CHAT_FILE) == signature:
+                upgrade_chat_log_file()
+    return df
+
+def read_messages_df(max_rows=None):
+    """Read messages from the Parquet archive and CSV log as a DataFrame
+    
+    The index holds each message's position in the full history, and
+    deleted messages are left out. With max_rows set, only the most recent
+    max_rows messages are read. Read errors are raised to the caller.
+    """
+    frames = []
+    archive_rows = 0
+    archive_signature = file_signature(CHAT_ARCHIVE_FILE)
+    if archive_signature is not None:
+        if max_rows is None:
+            archive_df = read_parquet_cached(CHAT_ARCHIVE_FILE, archive_signature)
+        else:
+            archive_df = read_parquet_tail_cached(CHAT_ARCHIVE_FILE, archive_signature, max_rows)
+        # Older archives get their missing columns back at the next compaction
+        upgrade_chat_columns(archive_df)
+        if not archive_df.empty:
+            archive_rows = archive_df.index[-1] + 1
+        frames.append(archive_df)
+    
+    df = load_chat_log_df()
+    df.index = pd.RangeIndex(archive_rows, archive_rows + len(df))
+    frames.append(df)
+    
+    df = frames[0] if len(frames) == 1 else pd.concat(frames)
+    deleted = get_deleted_indices()
+    if deleted:
+        df = df[~df.index.isin(deleted)]
+    if max_rows is not None:
+        df = df.tail(max_rows)
+    return df
+
+def write_parquet(df, path):
+    """Write a DataFrame to a Parquet file"""
+    df.to_parquet(path, index=False, compression='zstd', row_group_size=CHAT_ARCHIVE_ROW_GROUP)
+
+def remove_file(path):
+    """Remove a file if it exists"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def finish_chat_compaction():
+    """Complete a compaction whose marker file was written but whose old files remain
+    
+    The marker lists the Parquet files the compaction wrote as .tmp files.
+    Until it exists the old archive, log and deleted-message files stay
+    authoritative; once it exists they are replaced, so a crash at any point
+    leaves the history either fully before or fully after the compaction.
+    """
+    if not os.path.exists(CHAT_COMPACT_MARKER_FILE):
+        return
+    with chat_log_handle()['lock']:
+        # Another thread may have finished it while we waited for the lock
         try:
-            df = pd.read_csv(CHAT_FILE)
-            # Ensure recipient column exists for backwards compatibility
-            if 'recipient' not in df.columns:
-                df['recipient'] = 'everyone'
-                df.to_csv(CHAT_FILE, index=False)
-            return df.to_dict('records')
+            with open(CHAT_COMPACT_MARKER_FILE, encoding='utf-8') as f:
+                written_files = f.read().splitlines()
+        except FileNotFoundError:
+            return
+        for path in written_files:
+            if os.path.exists(f"{path}.tmp"):
+                os.replace(f"{path}.tmp", path)
+        # Message indices shift once the archive is rewritten
+        close_chat_log_handle()
+        remove_file(CHAT_FILE)
+        remove_file(DELETED_MESSAGES_FILE)
+        remove_file(CHAT_COMPACT_MARKER_FILE)
+
+def write_chat_archive(df, shard_df=None):
+    """Replace the stored chat history with the given messages, moving shard_df to a new shard"""
+    written_files = []
+    if shard_df is not None:
+        shard_file = f"{CHAT_SHARD_PREFIX}{datetime.now().strftime('%Y%m%d-%H%M%S')}.parquet"
+        write_parquet(shard_df[CHAT_COLUMNS], f"{shard_file}.tmp")
+        written_files.append(shard_file)
+    write_parquet(df[CHAT_COLUMNS], f"{CHAT_ARCHIVE_FILE}.tmp")
+    written_files.append(CHAT_ARCHIVE_FILE)
+    
+    # Writing the marker commits the compaction; finishing it swaps the files in
+    temp_marker = f"{CHAT_COMPACT_MARKER_FILE}.tmp"
+    with open(temp_marker, 'w', encoding='utf-8') as f:
+        f.write("\n".join(written_files))
+    os.replace(temp_marker, CHAT_COMPACT_MARKER_FILE)
+    finish_chat_compaction()
+
+def compact_chat_log():
+    """Fold the CSV message log into the Parquet archive and drop deleted messages"""
+    # Hold the log lock until the old files are gone so no message or
+    # deletion lands in a file that is about to be removed
+    with chat_log_handle()['lock']:
+        finish_chat_compaction()
+        # Rewriting from a partial read would lose history, so skip compaction
+        # and leave every file in place if anything can't be read
+        try:
+            df = read_messages_df()
         except Exception as e:
+            st.error(f"Error compacting messages: {e}")
+            return
+        # All but the most recent messages move to a dated shard once the archive is full
+        if len(df) > CHAT_ARCHIVE_MAX_ROWS:
+            write_chat_archive(df.iloc[-MAX_LOADED_MESSAGES:], df.iloc[:-MAX_LOADED_MESSAGES])
+        else:
+            write_chat_archive(df)
+
+def list_chat_shards():
+    """List the rotated chat history shards, oldest first"""
+    return sorted(
+        name for name in os.listdir('.')
+        if name.startswith(CHAT_SHARD_PREFIX) and name.endswith('.parquet')
+    )
+
+@st.cache_data(show_spinner=False, max_entries=1)
+def shard_stats_cached(shard_signatures):
+    """Count total and public messages across the rotated shards, once per shard change"""
+    total_msgs, public_msgs = 0, 0
+    for path, _ in shard_signatures:
+        recipients = pd.read_parquet(path, columns=['recipient'])['recipient']
+        total_msgs += len(recipients)
+        public_msgs += int((recipients == 'everyone').sum())
+    return total_msgs, public_msgs
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def archive_stats_cached(signature, deleted_signature):
+    """Count total and public archived messages, recomputed only when the archive or deletions change"""
+    recipients = pd.read_parquet(CHAT_ARCHIVE_FILE, columns=['recipient'])['recipient']
+    recipients = recipients[~recipients.index.isin(get_deleted_indices())]
+    return len(recipients), int((recipients == 'everyone').sum())
+
+def get_chat_stats():
+    """Get total and public message counts"""
+    try:
+        finish_chat_compaction()
+        # Rotated shards never change once written, so their counts stay cached
+        total_msgs, public_msgs = shard_stats_cached(
+            tuple((path, file_signature(path)) for path in list_chat_shards())
+        )
+        archive_signature = file_signature(CHAT_ARCHIVE_FILE)
+        if archive_signature is not None:
+            archive_msgs, archive_public = archive_stats_cached(
+                archive_signature, file_signature(DELETED_MESSAGES_FILE)
+            )
+            total_msgs += archive_msgs
+            public_msgs += archive_public
+        
+        # The CSV log stays small, so counting it directly is cheap
+        log_df = load_chat_log_df()
+        archive_rows = count_archived_messages()
+        log_positions = pd.RangeIndex(archive_rows, archive_rows + len(log_df))
+        log_recipients = log_df['recipient'][~log_positions.isin(get_deleted_indices())]
+        total_msgs += len(log_recipients)
+        public_msgs += int((log_recipients == 'everyone').sum())
+        return total_msgs, public_msgs
+    except Exception as e:
+        st.error(f"Error loading message statistics: {e}")
+        return 0, 0
+
+def chat_files_signature():
+    """Get a combined signature of the archive, message log and deleted-message files"""
+    finish_chat_compaction()
+    return (
+        file_signature(CHAT_ARCHIVE_FILE),
+        file_signature(CHAT_FILE),
+        file_signature(DELETED_MESSAGES_FILE)
+    )
+
+def add_message_html(df):
+    """Add HTML-escaped copies of the message fields that are shown on the page"""
+    return df.assign(
+        message_html=df['message'].astype(str).map(html.escape).str.replace('\n', '<br>', regex=False),
+        email_html=df['email'].astype(str).map(html.escape),
+        recipient_html=df['recipient'].astype(str).map(html.escape),
+        user_id_html=df['user_id'].fillna('unknown').astype(str).map(html.escape),
+        timestamp_html=df['timestamp'].astype(str).map(html.escape)
+    )
+
+def get_session_messages():
+    """Get the recent messages kept in session state, reloading them if the chat files changed"""
+    signature = chat_files_signature()
+    if st.session_state.messages_signature != signature:
+        try:
+            messages_df = read_messages_df(MAX_LOADED_MESSAGES)
+            stored_message_count = count_archived_messages() + len(load_chat_log_df())
+        except Exception as e:
+            # Leave the signature unset so the next run tries again
             st.error(f"Error loading messages: {e}")
-            return []
-    return []
+            st.session_state.messages_signature = None
+            return pd.DataFrame(columns=CHAT_COLUMNS)
+        # Escape once per load so reruns only join prepared strings
+        st.session_state.messages = add_message_html(messages_df)
+        st.session_state.messages_signature = signature
+        st.session_state.stored_message_count = stored_message_count
+    return st.session_state.messages
+
+def remember_sent_message(new_row, files_before, signature_after):
+    """Add a message this session just saved to its session copy instead of reloading
+    
+    files_before holds the archive signature, log size and deleted-messages
+    signature right before the append, and signature_after the chat files
+    signature right after it, both read under the log lock.
+    """
+    # Reload instead if anything was written since the copy was loaded,
+    # since the new row's index would then be wrong
+    loaded = st.session_state.messages_signature
+    if (loaded is None or
+            (loaded[0], loaded[1][1] if loaded[1] else 0, loaded[2]) != files_before):
+        st.session_state.messages_signature = None
+        return
+    
+    new_df = add_message_html(pd.DataFrame([new_row], index=[st.session_state.stored_message_count]))
+    st.session_state.messages = pd.concat([st.session_state.messages, new_df]).tail(MAX_LOADED_MESSAGES)
+    st.session_state.stored_message_count += 1
+    # A compaction right after the append changes the files again and forces a reload
+    st.session_state.messages_signature = signature_after
 
 def save_message(email, user_id, message, recipient="everyone"):
-    """Save a new message to CSV file with user verification"""
+    """Save a new message to CSV file with user verification
+    
+    Returns (row, files_before, signature_after) for remember_sent_message,
+    or None if saving failed.
+    """
     try:
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         new_row = {
-            'timestamp': timestamp,
+            'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
             'email': email,
             'user_id': user_id,
             'message': message,
-            'recipient': recipient
+            'recipient': recipient,
+            'kind': message_kind(recipient)
         }
-        
-        if os.path.exists(CHAT_FILE):
-            df = pd.read_csv(CHAT_FILE)
-            df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-        else:
-            df = pd.DataFrame([new_row])
-        
-        df.to_csv(CHAT_FILE, index=False)
-        return True
+        with chat_log_handle()['lock']:
+            finish_chat_compaction()
+            archive_signature = file_signature(CHAT_ARCHIVE_FILE)
+            deleted_signature = file_signature(DELETED_MESSAGES_FILE)
+            size_before, log_size = append_chat_row([new_row[column] for column in CHAT_COLUMNS])
+            signature_after = chat_files_signature()
+            
+            if log_size > CHAT_COMPACT_BYTES:
+                compact_chat_log()
+        return new_row, (archive_signature, size_before, deleted_signature), signature_after
     except Exception as e:
         st.error(f"Error saving message: {e}")
-        return False
+        return None
 
-def get_filtered_messages(user_email):
-    """Get messages that the current user should see"""
-    messages = load_messages()
-    filtered_messages = []
-    user_groups = get_user_groups(user_email)
-    user_group_ids = [group['group_id'] for group in user_groups]
-    
-    for i, msg in enumerate(messages):
-        recipient = msg.get('recipient', 'everyone')
-        sender_email = msg.get('email', '')
-        
-        # Show message if:
-        # 1. It's a public message (recipient = "everyone")
-        # 2. It's sent TO the current user
-        # 3. It's sent BY the current user
-        # 4. It's sent to a group the user is a member of
-        should_show = (
-            recipient == "everyone" or 
-            recipient == user_email or 
-            sender_email == user_email or
-            recipient in user_group_ids
-        )
+def get_filtered_messages(user_email, user_groups=None):
+    """Get a DataFrame of the messages the current user should see"""
+    df = get_session_messages()
+    if df.empty:
+        return df
+    
+    if user_groups is None:
+        user_groups = get_user_groups(user_email)
+    
+    # Show message if:
+    # 1. It's a public message (recipient = "everyone")
+    # 2. It's sent TO the current user
+    # 3. It's sent to a group the user is a member of
+    # 4. It's sent BY the current user
+    # The first three are one hashed lookup over the recipient column
+    visible_recipients = {"everyone", user_email}
+    visible_recipients.update(group['group_id'] for group in user_groups)
+    mask = df['recipient'].isin(visible_recipients) | (df['email'] == user_email)
+    
+    filtered_df = df.loc[mask].copy()
+    filtered_df['message_index'] = filtered_df.index  # Add index for deletion
+    
+    # Classify messages once here so the render loop only reads flags
+    filtered_df['is_public'] = filtered_df['kind'] == 'public'
+    filtered_df['is_group'] = filtered_df['kind'] == 'group'
+    filtered_df['is_sent_by_user'] = filtered_df['email'] == user_email
+    
+    # Display names are the part of the email before the @, already escaped
+    filtered_df['display_name'] = filtered_df['email_html'].str.split('@').str[0]
+    filtered_df['recipient_name'] = filtered_df['recipient_html'].str.split('@').str[0]
+    group_name_by_id = {group['group_id']: html.escape(group['group_name']) for group in user_groups}
+    filtered_df['group_name'] = filtered_df['recipient'].map(group_name_by_id)
+    return filtered_df
+
+def render_messages(user_groups):
+    """Render the messages the current user should see as one HTML string
+    
+    Returns the HTML and the user's own displayed messages, or (None, [])
+    if there is nothing to show.
+    """
+    messages_df = get_filtered_messages(st.session_state.user_email, user_groups)
+    
+    if messages_df.empty:
+        return None, []
+    
+    # Only the latest messages are rendered, newest first
+    messages_df = messages_df.tail(MAX_DISPLAYED_MESSAGES).iloc[::-1]
+    
+    # Build every message block first and send them to the page in one call
+    message_blocks = []
+    
+    for msg in messages_df.itertuples(index=False):
+        # User-provided fields were escaped when the messages were loaded
+        timestamp = msg.timestamp_html
+        email = msg.email_html
+        user_id = msg.user_id_html
+        message = msg.message_html
+        display_name = msg.display_name
+        
+        # Determine message type for styling
+        is_private = not msg.is_public
+        is_sent_by_user = msg.is_sent_by_user
+        is_group_message = msg.is_group
         
-        if should_show:
-            msg['message_index'] = i  # Add index for deletion
-            filtered_messages.append(msg)
+        # Get recipient display name
+        recipient_display = ""
+        if is_private and not is_group_message:
+            recipient_display = f" (Private to {msg.recipient_name})"
+        elif is_group_message and isinstance(msg.group_name, str):
+            recipient_display = f" (Group: {msg.group_name})"
+        
+        if is_sent_by_user:
+            # User's own message - align right
+            bg_color = "#DCF8C6" if not is_private else "#E8F5E8"
+            message_blocks.append(
+                f'<div style="background-color: {bg_color}; padding: 10px; border-radius: 10px; margin: 5px 0; text-align: right;">'
+                f'<strong>You{recipient_display}:</strong> {message}'
+                f'<br><small style="color: #666;">ID: {user_id} | {timestamp}</small>'
+                f'</div>'
+            )
+        else:
+            # Other user's message - align left
+            bg_color = "#F1F1F1" if not is_private else "#FFF8DC"
+            privacy_text = " (Private)" if is_private and not is_group_message else ""
+            if is_group_message:
+                privacy_text = " (Group)"
+            message_blocks.append(
+                f'<div style="background-color: {bg_color}; padding: 10px; border-radius: 10px; margin: 5px 0;">'
+                f'<strong>{display_name}{privacy_text}:</strong> {message}'
+                f'<br><small style="color: #666;">ID: {user_id} | {email} | {timestamp}</small>'
+                f'</div>'
+            )
     
-    return filtered_messages
+    # Deletion is offered for the user's own messages only
+    own_messages = messages_df[messages_df['is_sent_by_user']].to_dict('records')
+    return "\n".join(message_blocks), own_messages
 
-def display_messages():
+def display_messages(user_groups):
     """Display messages that the current user should see"""
-    messages = get_filtered_messages(st.session_state.user_email)
+    if get_session_messages().empty:
+        st.info("No messages yet. Start the conversation!")
+        return
+    
+    # Re-render only when the loaded messages or the user's groups change
+    render_key = (
+        st.session_state.user_email,
+        st.session_state.messages_signature,
+        st.session_state.stored_message_count,
+        tuple((group['group_id'], group['group_name']) for group in user_groups)
+    )
+    cached = st.session_state.message_render_cache
+    if cached is None or cached[0] != render_key:
+        cached = (render_key, render_messages(user_groups))
+        st.session_state.message_render_cache = cached
+    messages_html, own_messages = cached[1]
     
-    if not messages:
+    if messages_html is None:
         st.info("No messages yet. Start the conversation!")
         return
     
-    # Display messages in reverse order (newest first)
-    for msg in reversed(messages):
-        timestamp = msg['timestamp']
-        email = msg['email']
-        user_id = msg.get('user_id', 'unknown')
-        message = msg['message']
-        recipient = msg.get('recipient', 'everyone')
-        message_index = msg.get('message_index', -1)
-        display_name = get_user_display_name(email)
-        
-        # Create a container for each message
-        with st.container():
-            col1, col2, col3 = st.columns([3, 1, 0.5])
-            
-            with col1:
-                # Determine message type for styling
-                is_private = recipient != "everyone"
-                is_sent_by_user = email == st.session_state.user_email
-                is_group_message = recipient.startswith('group_') if recipient != "everyone" else False
-                
-                # Get recipient display name
-                recipient_display = ""
-                if is_private and not is_group_message:
-                    recipient_display = f" (Private to {get_user_display_name(recipient)})"
-                elif is_group_message:
-                    # Find group name
-                    user_groups = get_user_groups(st.session_state.user_email)
-                    for group in user_groups:
-                        if group['group_id'] == recipient:
-                            recipient_display = f" (Group: {group['group_name']})"
-                            break
-                
-                if is_sent_by_user:
-                    # User's own message - align right
-                    bg_color = "#DCF8C6" if not is_private else "#E8F5E8"
-                    st.markdown(f"""
-                    <div style="background-color: {bg_color}; padding: 10px; border-radius: 10px; margin: 5px 0; text-align: right;">
-                        <strong>You{recipient_display}:</strong> {message}
-                        <br><small style="color: #666;">ID: {user_id}</small>
-                    </div>
-                    """, unsafe_allow_html=True)
-                else:
-                    # Other user's message - align left
-                    bg_color = "#F1F1F1" if not is_private else "#FFF8DC"
-                    privacy_text = " (Private)" if is_private and not is_group_message else ""
-                    if is_group_message:
-                        privacy_text = " (Group)"
-                    st.markdown(f"""
-                    <div style="background-color: {bg_color}; padding: 10px; border-radius: 10px; margin: 5px 0;">
-                        <strong>{display_name}{privacy_text}:</strong> {message}
-                        <br><small style="color: #666;">ID: {user_id} | {email}</small>
-                    </div>
-                    """, unsafe_allow_html=True)
-            
-            with col2:
-                st.caption(timestamp)
-            
-            with col3:
-                # Show delete button only for user's own messages
-                if is_sent_by_user:
-                    if st.button("🗑️", key=f"delete_{message_index}", help="Delete message"):
-                        if delete_message(message_index):
-                            st.success("Message deleted!")
-                            st.rerun()
-                        else:
-                            st.error("Failed to delete message")
+    st.markdown(messages_html, unsafe_allow_html=True)
+    if own_messages:
+        show_delete_message_form(own_messages)
+
+def show_delete_message_form(own_messages):
+    """Show a picker for deleting one of the user's own messages"""
+    with st.expander("🗑️ Delete a message"):
+        selected_index = st.selectbox(
+            "Message to delete:",
+            range(len(own_messages)),
+            format_func=lambda x: f"{own_messages[x]['timestamp']} - {str(own_messages[x]['message'])[:50]}",
+            key="delete_message_choice"
+        )
+        
+        if st.button("Delete Message"):
+            if delete_message(own_messages[selected_index]['message_index'], st.session_state.user_email):
+                st.success("Message deleted!")
+                st.rerun()
+            else:
+                st.error("Failed to delete message")
 
-def show_user_stats():
+def show_user_stats(user_groups):
     """Show registered users statistics and groups"""
-    if os.path.exists(USERS_FILE):
-        users_df = pd.read_csv(USERS_FILE)
+    registered_users = get_registered_users()
+    if registered_users:
         st.sidebar.subheader("Chat Statistics")
-        st.sidebar.write(f"Total registered users: {len(users_df)}")
+        st.sidebar.write(f"Total registered users: {len(registered_users)}")
         
-        if os.path.exists(CHAT_FILE):
-            chat_df = pd.read_csv(CHAT_FILE)
-            st.sidebar.write(f"Total messages: {len(chat_df)}")
+        total_msgs, public_msgs = get_chat_stats()
+        if total_msgs:
+            st.sidebar.write(f"Total messages: {total_msgs}")
             
             # Count private vs public messages
-            if 'recipient' in chat_df.columns:
-                public_msgs = len(chat_df[chat_df['recipient'] == 'everyone'])
-                private_msgs = len(chat_df) - public_msgs
-            else:
-                # For backwards compatibility with old chat logs
-                public_msgs = len(chat_df)
-                private_msgs = 0
+            private_msgs = total_msgs - public_msgs
             st.sidebar.write(f"Public messages: {public_msgs}")
             st.sidebar.write(f"Private messages: {private_msgs}")
         
         # Show user's groups
-        user_groups = get_user_groups(st.session_state.user_email)
         if user_groups:
             st.sidebar.subheader("Your Groups")
             for group in user_groups:
@@ -326,12 +870,15 @@ def show_user_stats():
         
         # Show registered users list
         st.sidebar.subheader("Registered Users")
-        current_users = users_df[users_df['email'] != st.session_state.user_email]
+        current_users = [
+            (email, user_id) for email, user_id in registered_users
+            if email != st.session_state.user_email
+        ]
         
-        if not current_users.empty:
-            for _, user in current_users.iterrows():
-                display_name = get_user_display_name(user['email'])
-                st.sidebar.write(f"• {display_name} ({user['user_id']})")
+        if current_users:
+            for email, user_id in current_users:
+                display_name = get_user_display_name(email)
+                st.sidebar.write(f"• {display_name} ({user_id})")
         else:
             st.sidebar.write("No other users registered yet.")
 
@@ -343,17 +890,16 @@ def show_create_group_form():
         group_name = st.text_input("Group Name:", placeholder="Enter group name")
         
         # Get all registered users except current user
-        all_users = get_registered_users()
-        other_users = [user for user in all_users if user['email'] != st.session_state.user_email]
+        other_emails = [email for email in get_registered_emails() if email != st.session_state.user_email]
         
-        if other_users:
+        if other_emails:
             st.write("Select members:")
             selected_members = []
             
-            for user in other_users:
-                display_name = get_user_display_name(user['email'])
-                if st.checkbox(f"{display_name} ({user['email']})", key=f"member_{user['email']}"):
-                    selected_members.append(user['email'])
+            for email in other_emails:
+                display_name = get_user_display_name(email)
+                if st.checkbox(f"{display_name} ({email})", key=f"member_{email}"):
+                    selected_members.append(email)
             
             create_button = st.form_submit_button("Create Group")
             
@@ -374,6 +920,35 @@ def show_create_group_form():
         else:
             st.info("No other users registered yet. Groups need at least 2 members.")
 
+def get_recipient_choices(user_email):
+    """Get recipient dropdown (value, label) pairs and group names, rebuilt only when users or groups change"""
+    cache_key = (
+        user_email,
+        file_signature(USERS_FILE),
+        file_signature(GROUPS_FILE),
+        file_signature(GROUP_MEMBERS_FILE)
+    )
+    cached = st.session_state.recipient_cache
+    if cached is not None and cached[0] == cache_key:
+        return cached[1]
+    
+    recipient_choices = [("everyone", "everyone (Public)")]
+    
+    # Add individual users
+    for email in get_registered_emails():
+        if email != user_email:
+            recipient_choices.append((email, f"{get_user_display_name(email)} (Private)"))
+    
+    # Add groups
+    group_name_by_id = {}
+    for group in get_user_groups(user_email):
+        recipient_choices.append((group['group_id'], f"{group['group_name']} (Group)"))
+        group_name_by_id[group['group_id']] = group['group_name']
+    
+    choices = (recipient_choices, group_name_by_id)
+    st.session_state.recipient_cache = (cache_key, choices)
+    return choices
+
 # Main app logic
 def main():
     st.title("💬 Advanced Chat App")
@@ -394,7 +969,7 @@ def main():
                     st.session_state.logged_in = True
                     st.session_state.user_email = email
                     st.session_state.user_id = user_id
-                    st.session_state.messages = load_messages()
+                    st.session_state.messages_signature = None
                     
                     if is_new_user:
                         st.success(f"Welcome! Your unique ID is: {user_id}")
@@ -424,13 +999,19 @@ def main():
                 st.session_state.logged_in = False
                 st.session_state.user_email = ""
                 st.session_state.user_id = ""
-                st.session_state.messages = []
+                st.session_state.messages = None
+                st.session_state.messages_signature = None
                 st.session_state.selected_recipient = "everyone"
                 st.session_state.show_create_group = False
+                st.session_state.recipient_cache = None
+                st.session_state.message_render_cache = None
                 st.rerun()
         
+        # Load the user's groups once for the sidebar and the message list
+        user_groups = get_user_groups(st.session_state.user_email)
+        
         # Show user stats in sidebar
-        show_user_stats()
+        show_user_stats(user_groups)
         
         # Show create group form if requested
         if st.session_state.show_create_group:
@@ -442,42 +1023,25 @@ def main():
         
         # Refresh button
         if st.button("🔄 Refresh Chat"):
-            st.session_state.messages = load_messages()
+            st.session_state.messages_signature = None
             st.rerun()
         
         # Display messages
-        display_messages()
+        display_messages(user_groups)
         
         # Message input section
         st.subheader("Send a Message")
         
         # Recipient selection
-        registered_users = get_registered_users()
-        other_users = [user for user in registered_users if user['email'] != st.session_state.user_email]
-        user_groups = get_user_groups(st.session_state.user_email)
-        
-        recipient_options = ["everyone (Public)"]
-        recipient_values = ["everyone"]
-        
-        # Add individual users
-        for user in other_users:
-            display_name = get_user_display_name(user['email'])
-            recipient_options.append(f"{display_name} (Private)")
-            recipient_values.append(user['email'])
-        
-        # Add groups
-        for group in user_groups:
-            recipient_options.append(f"{group['group_name']} (Group)")
-            recipient_values.append(group['group_id'])
+        recipient_choices, group_name_by_id = get_recipient_choices(st.session_state.user_email)
         
-        if len(recipient_options) > 1:
-            selected_index = st.selectbox(
+        if len(recipient_choices) > 1:
+            selected_recipient, _ = st.selectbox(
                 "Send message to:",
-                range(len(recipient_options)),
-                format_func=lambda x: recipient_options[x],
+                recipient_choices,
+                format_func=lambda choice: choice[1],
                 index=0
             )
-            selected_recipient = recipient_values[selected_index]
         else:
             st.info("No other users or groups available. Your message will be public.")
             selected_recipient = "everyone"
@@ -489,25 +1053,20 @@ def main():
             
             if submit_button:
                 if message.strip():
-                    success = save_message(
+                    saved = save_message(
                         st.session_state.user_email, 
                         st.session_state.user_id, 
                         message.strip(),
                         selected_recipient
                     )
                     
-                    if success:
-                        st.session_state.messages = load_messages()
+                    if saved is not None:
+                        remember_sent_message(*saved)
                         
                         if selected_recipient == "everyone":
                             st.success("Public message sent!")
-                        elif selected_recipient.startswith('group_'):
-                            # Find group name
-                            group_name = "Unknown Group"
-                            for group in user_groups:
-                                if group['group_id'] == selected_recipient:
-                                    group_name = group['group_name']
-                                    break
+                        elif message_kind(selected_recipient) == 'group':
+                            group_name = group_name_by_id.get(selected_recipient, "Unknown Group")
                             st.success(f"Message sent to group '{group_name}'!")
                         else:
                             recipient_name = get_user_display_name(selected_recipient)